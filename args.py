@@ -33,13 +33,19 @@ def parse_args():
     # Model
     parser.add_argument('--model', choices=model_attributes.keys(), default='resnet50')
     parser.add_argument('--train_from_scratch', action='store_true', default=False)
+    parser.add_argument('--no_compile', action='store_true', default=False,
+                        help="Do not compile the CIFAR10 ResNet50 and the linear heads on precomputed features "
+                        "(compilation needs torch >= 2.2, older versions never compile)")
     parser.add_argument('--model_kwargs', nargs='*', action=ParseKwargs, default={},
                         help='keyword arguments for model initialization. Example: key1=value1')
     # Optimization
     parser.add_argument('--n_epochs', type=int, default=4)
     parser.add_argument('--batch_size', type=int, default=2)
     parser.add_argument('--lr', type=float, default=0.001)
-    parser.add_argument('--optimizer', type=str, default='SGD')
+    parser.add_argument('--lr_scaling', choices=['none', 'linear', 'sqrt'], default='linear',
+                        help="Rule to scale the learning rate with the number of DDP processes")
+    parser.add_argument('--optimizer', type=str, default='SGD',
+                        help="SGD, Adam, AdamW, adamw8bit (needs bitsandbytes) or adam_mini (needs adam-mini)")
     parser.add_argument('--scheduler', type=str, default=None)
     parser.add_argument('--weight_decay', type=float, default=0.0001)
     parser.add_argument('--gamma', type=float, default=0.1)
@@ -49,6 +55,12 @@ def parse_args():
     parser.add_argument('--mix_alpha', default=2, type=float)
     parser.add_argument('--cut_mix', default=False, action='store_true')
     parser.add_argument('--num_warmup_steps', default=0, type=int)
+    parser.add_argument('--no_foreach', action='store_true', default=False,
+                        help="Disable the multi-tensor (foreach) optimizer implementation to lower peak memory")
+    parser.add_argument('--no_fused', action='store_true', default=False,
+                        help="Disable the fused CUDA optimizer implementation")
+    parser.add_argument('--ddp_bucket_mb', type=int, default=25,
+                        help="Size of the DDP gradient buckets in MB")
     # baseline
     parser.add_argument('--reweight_groups', action='store_true', default=False)
     parser.add_argument("--coral", action='store_true', default=False)
@@ -78,6 +90,8 @@ def parse_args():
     parser.add_argument("--c_svm", default=0.1, type=float, help="Regularization for SVMs")
     # Misc
     parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--deterministic', default=False, action='store_true',
+                        help="Use deterministic cuDNN kernels instead of autotuning them")
     parser.add_argument('--show_progress', default=False, action='store_true')
     parser.add_argument('--log_dir', default='./logs')
     parser.add_argument('--log_every', default=50, type=int)
@@ -76,7 +76,7 @@ def run_epoch(
                         outputs, y[g==group], g[g==group], is_training, 
                         mix_up=args.mix_up, y_onehot=y_onehot
                         )
-                    optimizer_inner.zero_grad()
+                    optimizer_inner.zero_grad(set_to_none=True)
                     loss_main += loss
                     loss.backward()
                     optimizer_inner.step()
@@ -140,23 +140,22 @@ def run_epoch(
                 loss_main += penalty[0] * 0.1
 
             if (not args.fish) and is_training:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 loss_main.backward()
                 optimizer.step()
 
             if is_training and (batch_idx+1) % log_every==0:
                 csv_logger.log(epoch, batch_idx, loss_computer.get_stats(model, args, is_training))
-                csv_logger.flush()
                 loss_computer.log_stats(logger, is_training)
                 loss_computer.reset_stats()
 
         if (not is_training) or loss_computer.batch_count > 0:
             model = model.cuda()
             csv_logger.log(epoch, batch_idx, loss_computer.get_stats(model, args, is_training))
-            csv_logger.flush()
             loss_computer.log_stats(logger, is_training)
             if is_training:
                 loss_computer.reset_stats()
+        csv_logger.flush()
     if scheduler is not None:                        
         scheduler.step()
                 
@@ -264,13 +263,13 @@ def run_epoch_mix_every_batch(
                                                            x=x, y=y, g=g, y_onehot=y_onehot, model=model)
         loss_main = loss_computer.loss(outputs, all_y.cuda(), all_group.cuda(), is_training,
                                        mix_up=args.lisa_mix_up, y_onehot=all_mix_y.cuda())
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss_main.backward()
         optimizer.step()
         if (count+1) % log_every == 0:
             csv_logger.log(epoch, batch_idx, loss_computer.get_stats(model, args))
-            csv_logger.flush()
             loss_computer.log_stats(logger, is_training)
             loss_computer.reset_stats()
         count+=1
+    csv_logger.flush()
     return count
\ No newline at end of file
@@ -123,19 +123,18 @@ def run_epoch_disc(
                     )
                     
             if is_training:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 loss_main.backward()
                 optimizer.step()
 
             if is_training and (batch_idx + 1) % log_every==0:
                 csv_logger.log(epoch, batch_idx, loss_computer.get_stats(model, args, is_training))
-                csv_logger.flush()
                 loss_computer.log_stats(logger, is_training)
                 loss_computer.reset_stats()
 
         if (not is_training) or loss_computer.batch_count > 0:
             csv_logger.log(epoch, batch_idx, loss_computer.get_stats(model, args, is_training))
-            csv_logger.flush()
             loss_computer.log_stats(logger, is_training)
             if is_training:
-                loss_computer.reset_stats()
\ No newline at end of file
+                loss_computer.reset_stats()
+        csv_logger.flush()
\ No newline at end of file
@@ -8,7 +8,8 @@ import torch.nn.functional as F
 
 from disc.utils.loss import LossComputer
 from disc.utils.cluster import cluter_assignment
-from disc.utils.tools import CSVLogger, set_required_grad, get_optimizer, get_scheduler, calculate_weight_decay
+from disc.utils.tools import CSVLogger, set_required_grad, get_optimizer, get_scheduler, calculate_weight_decay, \
+    calculate_lr, save_checkpoint
 
 from disc.models import NetBottom, NetTop
 from disc.run_epoch_disc import run_epoch_disc
@@ -74,6 +75,7 @@ def train(
     args.weight_decay = calculate_weight_decay(args, dataset['train_data'])
     t_total = args.n_epochs
     optimizer = get_optimizer(args, model)
+    logger.write(f'Learning rate: {calculate_lr(args)} (lr_scaling={args.lr_scaling})\n')
     scheduler = get_scheduler(args, optimizer, t_total)
     set_required_grad(model, True)
 
@@ -210,7 +212,7 @@ def train(
         if epoch % args.save_step == 0:
             torch.save(model, osp.join(args.log_dir, '%d_model.pth' % epoch))
         if args.save_last:
-            torch.save(model, osp.join(args.log_dir, 'last_model.pth'))
+            save_checkpoint(model, osp.join(args.log_dir, 'last_model.safetensors'), epoch)
         if args.save_best:
             if args.dataset == 'ISIC':
                 curr_val_perf = val_loss_computer.roc_auc
@@ -222,6 +224,7 @@ def train(
                 best_val_perf = curr_val_perf
                 torch.save(model, osp.join(args.log_dir, 'best_model.pth'))
                 logger.write(f'Best model saved at epoch {epoch}\n')
+        logger.sync()
         
         # Automatic adjust training loss computer
         if args.automatic_adjustment:
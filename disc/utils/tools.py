@@ -5,20 +5,23 @@ import math
 import numpy as np
 import csv
 import argparse
+import inspect
 import torch.nn as nn
-import torch
-import operator
+import torch.distributed as dist
 from numbers import Number
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from torch.optim.lr_scheduler import StepLR
-from transformers import (get_linear_schedule_with_warmup,
-                          get_cosine_schedule_with_warmup)
-import torchvision
-import timm
-from typing import Collection
+from safetensors.torch import load_file, save_file
+from typing import Any, Collection, Dict, List
 from disc.models import model_attributes
 from disc.models import ResNet50
 
+# Let the CUDA caching allocator grow segments in place so that the memory spike from
+# loading a checkpoint does not stay reserved for the rest of training (torch >= 2.1)
+if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 
 def check_args(args):
     if args.shift_type == 'confounder':
@@ -32,52 +35,38 @@ def check_args(args):
 
 
 def set_required_grad(model, required_grad=True):
-    for p in model.parameters():
-        p.requires_grad = required_grad
-    return model
+    # In-place, the model is returned for convenience only
+    return model.requires_grad_(required_grad)
+
+
+# Method flag -> (method name, log dir template), checked in order of precedence
+_METHOD_TEMPLATES = {
+    'disc': ('DISC', '{concept_categories}-n_concept_imgs={n_concept_imgs:d}-n_clusters={n_clusters}'),
+    'lisa_mix_up': ('LISA', 'mix_ratio={mix_ratio}-mix_alpha={mix_alpha}-cut_mix={cut_mix}-alpha={alpha}'),
+    'jtt': ('JTT', 'upweight={jtt_upweight}'),
+    'rex': ('REx', 'penalty={rex_penalty}'),
+    'irm': ('IRM', 'penalty={irm_penalty}'),
+    'ibirm': ('IBIRM', 'penalty={ibirm_penalty}'),
+    'fish': ('Fish', 'meta_lr={meta_lr}'),
+    'robust': ('GroupDRO', 'robust_step_size={robust_step_size}'),
+    'coral': ('Coral', ''),
+}
 
 
 def set_log_dir(args):
-    common_string = f'reweight_groups={int(args.reweight_groups)}-augment={int(args.augment_data)}-' + \
-                    f'lr={args.lr}-batch_size={args.batch_size}-n_epochs={args.n_epochs}'
-    if args.dataset == 'ISIC':
-        common_string += f'-trapset_id={args.seed}'
-    else:
-        common_string += f'-seed={args.seed}'
-    if args.disc:
-        method = 'DISC'
-        string = f'{args.concept_categories}-n_concept_imgs={int(args.n_concept_imgs)}-' + \
-                 f'n_clusters={args.n_clusters}'
-    elif args.lisa_mix_up:
-        method = 'LISA'
-        string = f'mix_ratio={args.mix_ratio}-mix_alpha={args.mix_alpha}-' + \
-                 f'cut_mix={args.cut_mix}-alpha={args.alpha}'
-    elif args.jtt:
-        method = 'JTT'
-        string = f'upweight={args.jtt_upweight}'
-    elif args.rex:
-        method = 'REx'
-        string = f'penalty={args.rex_penalty}'
-    elif args.irm:
-        method = 'IRM'
-        string = f'penalty={args.irm_penalty}'
-    elif args.ibirm:
-        method = 'IBIRM'
-        string = f'penalty={args.ibirm_penalty}'
-    elif args.fish:
-        method = 'Fish'
-        string = f'meta_lr={args.meta_lr}'
-    elif args.robust:
-        method = 'GroupDRO'
-        string = f'robust_step_size={args.robust_step_size}'
-    elif args.coral:
-        method = 'Coral'
-        string = f''
-    else:
-        method = 'ERM'
-        string = f''
+    seed_name = 'trapset_id' if args.dataset == 'ISIC' else 'seed'
+    common_string = '-'.join((
+        f'reweight_groups={int(args.reweight_groups)}',
+        f'augment={int(args.augment_data)}',
+        f'lr={args.lr}',
+        f'batch_size={args.batch_size}',
+        f'n_epochs={args.n_epochs}',
+        f'{seed_name}={args.seed}'))
+    method, template = next(
+        (spec for flag, spec in _METHOD_TEMPLATES.items() if getattr(args, flag)), ('ERM', ''))
+    string = template.format_map(vars(args))
     if len(string):
-        string += f'-{common_string}'
+        string = '-'.join((string, common_string))
     else:
         string = common_string
     args.log_dir = os.path.join(args.log_dir, args.dataset, method, string)
@@ -89,13 +78,16 @@ def param_groups_weight_decay(
         no_weight_decay_list: Collection[str] = (),
 ):
     no_weight_decay_list = set(no_weight_decay_list)
+    # Resolve the name-based exclusions once, then match parameters by id
+    no_decay_ids = {id(param) for name, param in model.named_parameters()
+                    if name.endswith(".bias") or name in no_weight_decay_list}
     decay = []
     no_decay = []
-    for name, param in model.named_parameters():
+    for param in model.parameters():
         if not param.requires_grad:
             continue
 
-        if param.ndim <= 1 or name.endswith(".bias") or name in no_weight_decay_list:
+        if param.ndim <= 1 or id(param) in no_decay_ids:
             no_decay.append(param)
         else:
             decay.append(param)
@@ -105,37 +97,146 @@ def param_groups_weight_decay(
         {'params': decay, 'weight_decay': weight_decay}]
 
 
+def _expand_param_groups(params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Transform parameter groups into per-parameter structure.
+    # Later items in `params` can overwrite parameters set in previous items.
+    ret = defaultdict(dict)
+    for item in params:
+        assert "params" in item
+        cur_params = {x: y for x, y in item.items() if x != "params"}
+        for param in item["params"]:
+            ret[param].update({"params": [param], **cur_params})
+    return list(ret.values())
+
+
+def reduce_param_groups(params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merge parameter groups that share the same hyperparameters into a single group
+    Adapted from detectron2: https://github.com/facebookresearch/detectron2/blob/main/detectron2/solver/build.py
+    :param params: List of parameter groups
+    :return: List of parameter groups with unique hyperparameters
+    """
+    params = _expand_param_groups(params)
+    groups = defaultdict(list)  # re-group all parameter groups by their hyperparams
+    for item in params:
+        cur_params = tuple((x, y) for x, y in item.items() if x != "params")
+        groups[cur_params].extend(item["params"])
+    ret = []
+    for param_keys, param_values in groups.items():
+        cur = {kv[0]: kv[1] for kv in param_keys}
+        cur["params"] = param_values
+        ret.append(cur)
+    return ret
+
+
+def multi_tensor_optimizer(args, name, on_cuda):
+    """
+    Select the fused or multi-tensor (foreach) implementation of an optimizer
+    On torch < 1.12 the foreach implementations are the separate torch.optim._multi_tensor classes
+    :param args: Arguments from the command line
+    :param name: Name of the optimizer class in torch.optim
+    :param on_cuda: Whether all the parameters to optimize are on a CUDA device
+    :return: optimizer_cls: Optimizer class, kwargs: Dictionary of keyword arguments for the optimizer
+    """
+    optimizer_cls = getattr(torch.optim, name)
+    supported = inspect.signature(optimizer_cls).parameters
+    kwargs = {}
+    if 'fused' in supported and on_cuda and not args.no_fused:
+        kwargs['fused'] = True
+    elif 'foreach' in supported:
+        # Explicit, since foreach=None already picks the foreach path for CUDA parameters
+        kwargs['foreach'] = not args.no_foreach
+    elif not args.no_foreach:
+        try:
+            from torch.optim import _multi_tensor
+            optimizer_cls = getattr(_multi_tensor, name)
+        except ImportError:
+            pass
+    return optimizer_cls, kwargs
+
+
 def get_optimizer(args, model):
     param_groups = param_groups_weight_decay(
         model,
         weight_decay=args.weight_decay,
         no_weight_decay_list=args.no_weight_decay_list)
+    param_groups = reduce_param_groups(param_groups)
+    on_cuda = all(p.is_cuda for p in model.parameters())
+    lr = calculate_lr(args)
     if args.optimizer == 'SGD':
-        optimizer = torch.optim.SGD(
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'SGD', on_cuda)
+        optimizer = optimizer_cls(
             param_groups,
-            lr=args.lr,
-            momentum=0.9)
+            lr=lr,
+            momentum=0.9,
+            **kwargs)
     elif args.optimizer == 'Adam':
-        optimizer = torch.optim.Adam(param_groups, lr=args.lr)
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'Adam', on_cuda)
+        optimizer = optimizer_cls(
+            param_groups, lr=lr,
+            **kwargs)
     elif args.optimizer.lower() == 'adamw':
-        optimizer = torch.optim.AdamW(
-            param_groups, lr=args.lr)
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'AdamW', on_cuda)
+        optimizer = optimizer_cls(
+            param_groups, lr=lr,
+            **kwargs)
+    elif args.optimizer.lower() == 'adamw8bit':
+        # AdamW with block-wise 8-bit quantized optimizer states
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ImportError("--optimizer adamw8bit needs bitsandbytes: pip install bitsandbytes") from e
+        optimizer = bnb.optim.AdamW8bit(param_groups, lr=lr)
+    elif args.optimizer.lower() == 'adam_mini':
+        # Adam-mini shares the second moments within blocks of the Hessian (e.g. per attention head),
+        # so it needs the transformer dimensions and builds its own per-parameter groups
+        try:
+            from adam_mini import Adam_mini
+        except ImportError as e:
+            raise ImportError("--optimizer adam_mini needs Adam-mini: pip install adam-mini") from e
+        mini_kwargs = {}
+        if hasattr(model, 'embed_dim') and hasattr(model, 'blocks'):
+            mini_kwargs['dim'] = model.embed_dim
+            mini_kwargs['n_heads'] = model.blocks[0].attn.num_heads
+        optimizer = Adam_mini(
+            named_parameters=[(n, p) for n, p in model.named_parameters() if p.requires_grad],
+            lr=lr,
+            weight_decay=args.weight_decay,
+            **mini_kwargs)
+        # Adam-mini only exempts norm layers from weight decay, apply the same exclusions
+        # as param_groups_weight_decay (1-d params, biases, no_weight_decay_list)
+        no_decay_ids = {id(p) for group in param_groups if group['weight_decay'] == 0. for p in group['params']}
+        for group in optimizer.param_groups:
+            if any(id(p) in no_decay_ids for p in group['params']):
+                group['weight_decay'] = 0.
     else:
         raise ValueError(f"{args.optimizer} not recognized")
     return optimizer
 
 
 def get_model(args, n_classes, d=None, resume=False):
-    pretrained = not args.train_from_scratch
     args.no_weight_decay_list = ['pos_embed', 'cls_token', 'reg_token']
+    # The weights are overwritten by the checkpoint on resume, so skip loading the pretrained ones
+    model = _build_arch(args, n_classes, d, load_pretrained=not resume)
     if resume:
-        model = torch.load(os.path.join(args.log_dir, 'last_model.pth'))
-    elif args.dataset == 'CIFAR10':
+        state_dict = load_checkpoint(os.path.join(args.log_dir, 'last_model.safetensors'))
+        # Reuse the loaded storages as the parameters instead of copying them (torch >= 2.1)
+        assign = {'assign': True} if 'assign' in inspect.signature(model.load_state_dict).parameters else {}
+        model.load_state_dict(state_dict, **assign)
+    model = compile_model(args, model)
+    return model
+
+
+def _build_arch(args, n_classes, d=None, load_pretrained=True):
+    # Imported here to keep the import of this module light for every DDP rank
+    import torchvision
+    pretrained = load_pretrained and not args.train_from_scratch
+    if args.dataset == 'CIFAR10':
         # Use another resnet50 implementation
         # https://github.com/kuangliu/pytorch-cifar
         model = ResNet50()
     elif model_attributes[args.model]['feature_type'] in ('precomputed', 'raw_flattened'):
-        assert pretrained and d
+        assert not args.train_from_scratch and d
         # Load precomputed features
         model = nn.Linear(d, n_classes)
         model.has_aux_logits = False
@@ -156,14 +257,81 @@ def get_model(args, n_classes, d=None, resume=False):
         d = model.classifier.in_features
         model.classifier = nn.Linear(d, n_classes)
     elif args.model == 'vit_base_patch14_reg4_dinov2.lvd142m':
-        model = timm.create_model('vit_base_patch14_reg4_dinov2.lvd142m', pretrained=True, num_classes=n_classes,
-                                  img_size=224)
+        import timm
+        model = timm.create_model('vit_base_patch14_reg4_dinov2.lvd142m', pretrained=load_pretrained,
+                                  num_classes=n_classes, img_size=224)
         d = model.embed_dim
     else:
         raise ValueError('Model not recognized.')
     return model
 
 
+def compile_model(args, model):
+    """
+    Compile the forward pass of the models whose training steps are dominated by Python overhead
+    The module is compiled in place, so its children, state dict keys and pickling are unchanged.
+    nn.Module.compile needs torch >= 2.2, on older versions (e.g. the pinned 1.11) the model is returned as is
+    :param args: Arguments from the command line
+    :param model: Model built by _build_arch
+    :return: model: The same model, compiled if applicable
+    """
+    if args.no_compile or not torch.cuda.is_available() or not hasattr(nn.Module, 'compile'):
+        return model
+    if args.dataset == 'CIFAR10':
+        # Compute-bound, the one-time autotuning pays back within a few hundred iterations
+        model.compile(mode='max-autotune')
+    elif model_attributes[args.model]['feature_type'] in ('precomputed', 'raw_flattened'):
+        # A single linear layer, capture it as a CUDA graph to remove the launch overhead
+        model.compile(mode='reduce-overhead', fullgraph=True)
+    return model
+
+
+def wrap_ddp(model, local_rank, args):
+    """
+    Wrap the model with DistributedDataParallel using the shared communication settings
+    Gradients are views into the allreduce buckets and unused parameters are not searched.
+    Note that NetBottom/NetTop, Fish and the full-model saves expect the bare module, use `.module` there
+    :param model: Model to wrap
+    :param local_rank: Index of the GPU of this process on its node
+    :param args: Arguments from the command line
+    :return: model: DDP-wrapped model on the GPU of this process
+    """
+    # The graph is only static when each step is a single forward/backward through the DDP module:
+    # DISC, CORAL and IBIRM run the backbone outside of it, IRM/IBIRM take double gradients
+    # and Fish optimizes an inner copy of the model
+    static_graph = not (args.disc or args.coral or args.irm or args.ibirm or args.fish)
+    model = nn.parallel.DistributedDataParallel(
+        model.to(local_rank),
+        device_ids=[local_rank],
+        bucket_cap_mb=args.ddp_bucket_mb,
+        gradient_as_bucket_view=True,
+        static_graph=static_graph,
+        find_unused_parameters=False)
+    return model
+
+
+def save_checkpoint(model, path, epoch):
+    """
+    Save the weights of the model in the safetensors format, without pickling the module itself
+    :param model: Model to save, possibly wrapped with DDP
+    :param path: Path to the checkpoint
+    :param epoch: Epoch at which the checkpoint is saved, stored in the metadata
+    """
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    save_file(model.state_dict(), path, metadata={'epoch': str(epoch)})
+
+
+def load_checkpoint(path):
+    """
+    Load the weights of a checkpoint saved by save_checkpoint onto the CPU
+    The file is memory-mapped, so only the pages of the tensors that are read are touched
+    :param path: Path to the checkpoint
+    :return: state_dict: Dictionary of the weights
+    """
+    return load_file(path, device='cpu')
+
+
 def calculate_weight_decay(args, dataset_train):
     """
     Function to calculate the weight decay
@@ -186,7 +354,17 @@ def calculate_effective_batch_size(args):
     :return:
     effective_batch_size: int, effective batch size
     """
-    batch_size = args.batch_size
+    effective_batch_size = args.batch_size * get_world_size()
+    return effective_batch_size
+
+
+@lru_cache(maxsize=1)
+def get_world_size():
+    """
+    Get the number of processes taking part in training
+    :return:
+    world_size: int, number of processes (1 without DDP)
+    """
     use_ddp = multi_gpu_check()
     is_slurm_job = "SLURM_NODEID" in os.environ
     if is_slurm_job:
@@ -197,11 +375,43 @@ def calculate_effective_batch_size(args):
             world_size = int(os.environ['WORLD_SIZE'])
         else:
             world_size = 1
+    return world_size
 
-    effective_batch_size = batch_size * world_size
-    return effective_batch_size
+
+def calculate_lr(args):
+    """
+    Scale the learning rate with the number of processes, so that the effective batch size is accounted for under DDP
+    The scaling only applies once a process group is initialized
+    :param args: Arguments from the command line
+    :return: lr: Learning rate for the optimizer
+    """
+    if args.lr_scaling not in ('none', 'linear', 'sqrt'):
+        raise ValueError(f"{args.lr_scaling} not recognized")
+    if not (dist.is_available() and dist.is_initialized()):
+        # Without a process group every process trains on the full dataset on its own
+        return args.lr
+    world_size = dist.get_world_size()
+    if args.lr_scaling == 'linear':
+        lr = args.lr * world_size
+    elif args.lr_scaling == 'sqrt':
+        lr = args.lr * math.sqrt(world_size)
+    else:
+        lr = args.lr
+    return lr
+
+
+@lru_cache(maxsize=1)
+def is_rank_zero():
+    """
+    Check if the current process is the main process, with or without DDP
+    :return:
+    rank_zero: bool, whether the global rank of the process is 0
+    """
+    rank = os.environ.get('RANK', os.environ.get('SLURM_PROCID', 0))
+    return int(rank) == 0
 
 
+@lru_cache(maxsize=1)
 def multi_gpu_check():
     """
     Check if there are multiple GPUs available for DDP
@@ -217,23 +427,39 @@ def multi_gpu_check():
     return use_ddp
 
 
+def _reset_env_cache():
+    """Clear the cached results of the environment checks, e.g. after changing os.environ"""
+    get_world_size.cache_clear()
+    is_rank_zero.cache_clear()
+    multi_gpu_check.cache_clear()
+
+
 def get_optimizer_weights(args, weights):
+    weights = list(weights)
+    on_cuda = all(w.is_cuda for w in weights)
+    lr = calculate_lr(args)
     if args.optimizer == 'SGD':
-        optimizer = torch.optim.SGD(
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'SGD', on_cuda)
+        optimizer = optimizer_cls(
             weights,
-            lr=args.lr,
+            lr=lr,
             momentum=0.9,
-            weight_decay=args.weight_decay)
+            weight_decay=args.weight_decay,
+            **kwargs)
     elif args.optimizer == 'Adam':
-        optimizer = torch.optim.Adam(
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'Adam', on_cuda)
+        optimizer = optimizer_cls(
             weights,
-            lr=args.lr,
-            weight_decay=args.weight_decay)
+            lr=lr,
+            weight_decay=args.weight_decay,
+            **kwargs)
     elif args.optimizer.lower() == 'adamw':
-        optimizer = torch.optim.AdamW(
+        optimizer_cls, kwargs = multi_tensor_optimizer(args, 'AdamW', on_cuda)
+        optimizer = optimizer_cls(
             weights,
-            lr=args.lr,
-            weight_decay=args.weight_decay)
+            lr=lr,
+            weight_decay=args.weight_decay,
+            **kwargs)
     else:
         raise ValueError(f"{args.optimizer} not recognized")
     return optimizer
@@ -256,6 +482,7 @@ def get_scheduler(args, optimizer, t_total):
             T_max=t_total)
 
     elif args.scheduler == 'linear_schedule_with_warmup':
+        from transformers import get_linear_schedule_with_warmup
         scheduler = get_linear_schedule_with_warmup(
             optimizer,
             num_training_steps=t_total,
@@ -265,6 +492,7 @@ def get_scheduler(args, optimizer, t_total):
         use_metric = False
 
     elif args.scheduler == 'cosine_schedule_with_warmup':
+        from transformers import get_cosine_schedule_with_warmup
         scheduler = get_cosine_schedule_with_warmup(
             optimizer,
             num_training_steps=t_total,
@@ -296,7 +524,9 @@ class Logger(object):
     def __init__(self, fpath=None, mode='w'):
         self.console = sys.stdout
         self.file = None
-        if fpath is not None:
+        # Only the main process writes logs, so ranks do not contend on the same file
+        self.enabled = is_rank_zero()
+        if fpath is not None and self.enabled:
             self.file = open(fpath, mode)
 
     def __del__(self):
@@ -309,6 +539,8 @@ class Logger(object):
         self.close()
 
     def write(self, msg):
+        if not self.enabled:
+            return
         self.console.write(msg)
         if self.file is not None:
             self.file.write(msg)
@@ -317,9 +549,16 @@ class Logger(object):
         self.console.flush()
         if self.file is not None:
             self.file.flush()
+
+    def sync(self):
+        """Flush and force the log file to disk, e.g. around checkpoint saves"""
+        self.flush()
+        if self.file is not None:
             os.fsync(self.file.fileno())
 
     def close(self):
+        if self.file is not None and not self.file.closed:
+            self.sync()
         self.console.close()
         if self.file is not None:
             self.file.close()
@@ -334,21 +573,31 @@ class CSVLogger:
         columns.append(f'average')
 
         self.path = csv_path
-        self.file = open(csv_path, mode)
         self.columns = columns
-        self.writer = csv.DictWriter(self.file, fieldnames=columns)
-        if mode == 'w':
-            self.writer.writeheader()
+        self._data_cols = tuple(columns[1:])
+        self.file = None
+        # Only the main process writes, so ranks do not contend on the same file
+        if is_rank_zero():
+            # Large buffer, the rows reach the disk on flush() at the end of each epoch
+            self.file = open(csv_path, mode, buffering=1 << 20, newline='')
+            self.writer = csv.writer(self.file)
+            if mode == 'w':
+                self.writer.writerow(columns)
 
     def log(self, epoch, stats_dict):
-        stats_dict['epoch'] = epoch
-        self.writer.writerow(stats_dict)
+        if self.file is None:
+            return
+        row = [epoch]
+        row.extend(stats_dict.get(c, '') for c in self._data_cols)
+        self.writer.writerow(row)
 
     def flush(self):
-        self.file.flush()
+        if self.file is not None:
+            self.file.flush()
 
     def close(self):
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
 
 
 class CSVBatchLogger:
@@ -376,41 +625,73 @@ class CSVBatchLogger:
             columns.append("roc_auc")
 
         self.path = csv_path
-        self.file = open(csv_path, mode)
         self.columns = columns
-        self.writer = csv.DictWriter(self.file, fieldnames=columns)
-        if mode == 'w':
-            self.writer.writeheader()
+        self._data_cols = tuple(columns[2:])
+        self.file = None
+        # Only the main process writes, so ranks do not contend on the same file
+        if is_rank_zero():
+            self.file = open(csv_path, mode, buffering=1 << 20, newline='')
+            self.writer = csv.writer(self.file)
+            if mode == 'w':
+                self.writer.writerow(columns)
 
     def log(self, epoch, batch, stats_dict):
-        stats_dict['epoch'] = epoch
-        stats_dict['batch'] = batch
-        self.writer.writerow(stats_dict)
+        if self.file is None:
+            return
+        row = [epoch, batch]
+        row.extend(stats_dict.get(c, '') for c in self._data_cols)
+        self.writer.writerow(row)
 
     def flush(self):
-        self.file.flush()
+        if self.file is not None:
+            self.file.flush()
 
     def close(self):
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
 
 
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value
+    The running sum and count are kept as 0-dim tensors on `device` (CPU by default, so updates
+    stay cheap), so that the meters of all the ranks can be reduced together with `all_reduce_meters`"""
 
-    def __init__(self):
+    def __init__(self, device='cpu'):
+        self.device = device
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
+        # float64 like the Python floats used before, so long runs keep the sum and count exact
+        self.sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.count = torch.zeros((), dtype=torch.float64, device=self.device)
 
     def update(self, val, n=1):
         self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
+        if torch.is_tensor(val):
+            val = val.to(self.device)
+        self.sum.add_(val * n)
+        self.count.add_(n)
+
+    @property
+    def avg(self):
+        return (self.sum / self.count.clamp(min=1)).item()
+
+
+def all_reduce_meters(meters: List[AverageMeter]):
+    """
+    Sum the meters over all the ranks with a single collective call
+    Meters default to the CPU, so under NCCL the callers must build them with AverageMeter(device='cuda')
+    :param meters: List of AverageMeter on the same device, which must be supported by the process group backend
+    """
+    if not (dist.is_available() and dist.is_initialized()) or len(meters) == 0:
+        return
+    buffer = torch.stack([m.sum for m in meters] + [m.count for m in meters])
+    dist.all_reduce(buffer, op=dist.ReduceOp.SUM)
+    sums, counts = buffer.split(len(meters))
+    for meter, s, c in zip(meters, sums, counts):
+        meter.sum.copy_(s)
+        meter.count.copy_(c)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -418,27 +699,31 @@ def accuracy(output, target, topk=(1,)):
     maxk = max(topk)
     batch_size = target.size(0)
 
-    _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    temp = target.view(1, -1).expand_as(pred)
-    temp = temp.cuda()
-    correct = pred.eq(temp)
+    target = target.to(output.device, non_blocking=True)
+    pred = output.topk(maxk, 1, True, True).indices.t()
+    correct = pred.eq(target.view(1, -1))
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+        # Accumulate in float32 directly instead of materializing a float copy of the mask
+        correct_k = correct[:k].reshape(-1).sum(0, keepdim=True, dtype=torch.float32)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
 
-def set_seed(seed):
-    """Sets seed"""
+def set_seed(seed, deterministic=False):
+    """Sets seed
+    cuDNN autotuning is enabled unless `deterministic`, which trades speed for reproducible kernels"""
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
     torch.manual_seed(seed)
     np.random.seed(seed)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    if deterministic:
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+        torch.use_deterministic_algorithms(True, warn_only=True)
+    else:
+        torch.backends.cudnn.benchmark = True
 
 
 def log_args(args, logger):
@@ -447,22 +732,27 @@ def log_args(args, logger):
     logger.write('\n')
 
 
+_BOOL_STRINGS = {'True': True, 'true': True, 'False': False, 'false': False}
+
+
 # Taken from https://sumit-ghosh.com/articles/parsing-dictionary-key-value-pairs-kwargs-argparse-python/
 class ParseKwargs(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, dict())
         for value in values:
-            key, value_str = value.split('=')
-            if value_str.replace('-', '').isnumeric():
-                processed_val = int(value_str)
-            elif value_str.replace('-', '').replace('.', '').isnumeric():
-                processed_val = float(value_str)
-            elif value_str in ['True', 'true']:
-                processed_val = True
-            elif value_str in ['False', 'false']:
-                processed_val = False
-            else:
-                processed_val = value_str
+            key, value_str = value.split('=', 1)
+            processed_val = _BOOL_STRINGS.get(value_str, value_str)
+            # int()/float() also accept digit separators and nan/inf, keep those as strings
+            if '_' not in value_str:
+                try:
+                    processed_val = int(value_str)
+                except ValueError:
+                    try:
+                        number = float(value_str)
+                        if math.isfinite(number):
+                            processed_val = number
+                    except ValueError:
+                        pass
             getattr(namespace, self.dest)[key] = processed_val
 
 
@@ -474,23 +764,26 @@ class ParamDict(OrderedDict):
         super().__init__(*args, *kwargs)
 
     def _prototype(self, other, op):
+        # Apply `op` to all the tensors at once with the multi-tensor (foreach) kernels,
+        # keeping the results on the device of `self`
         if isinstance(other, Number):
-            return ParamDict({k: op(v, other).cpu() for k, v in self.items()})
+            return ParamDict(zip(self.keys(), op(list(self.values()), other)))
         elif isinstance(other, dict):
-            return ParamDict({k: op(self[k].cpu(), other[k].cpu()) for k in self})
+            others = [other[k].to(v.device) for k, v in self.items()]
+            return ParamDict(zip(self.keys(), op(list(self.values()), others)))
         else:
             raise NotImplementedError
 
     def __add__(self, other):
-        return self._prototype(other, operator.add)
+        return self._prototype(other, torch._foreach_add)
 
     def __rmul__(self, other):
-        return self._prototype(other, operator.mul)
+        return self._prototype(other, torch._foreach_mul)
 
     __mul__ = __rmul__
 
     def __neg__(self):
-        return ParamDict({k: -v for k, v in self.items()})
+        return ParamDict(zip(self.keys(), torch._foreach_neg(list(self.values()))))
 
     def __rsub__(self, other):
         # a- b := a + (-b)
@@ -499,4 +792,4 @@ class ParamDict(OrderedDict):
     __sub__ = __rsub__
 
     def __truediv__(self, other):
-        return self._prototype(other, operator.truediv)
+        return self._prototype(other, torch._foreach_div)
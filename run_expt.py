@@ -25,12 +25,12 @@ if __name__=='__main__':
     args = parse_args()
     set_log_dir(args)
     check_args(args)
-    set_seed(args.seed)
+    set_seed(args.seed, deterministic=args.deterministic)
 
     ## Initialize logs
     if not osp.exists(args.log_dir):
         os.makedirs(args.log_dir)
-    args.mode = 'a' if (osp.exists(osp.join(args.log_dir, 'last_model.pth')) and args.resume) else 'w'
+    args.mode = 'a' if (osp.exists(osp.join(args.log_dir, 'last_model.safetensors')) and args.resume) else 'w'
     logger = Logger(osp.join(args.log_dir, f'log.txt'), args.mode)
 
     # Prepare data